@@ -1,11 +1,14 @@
 # app.py（两表版 + 连续事件条月历 + 颜色区分 + 按日期预估库存 + 手机友好）
 # -*- coding: utf-8 -*-
-import io, re, calendar, zipfile
+import io, re, calendar, functools, hashlib, zipfile
+from collections import defaultdict
 from datetime import date, timedelta
 from typing import Dict, Tuple, List
 
+import numpy as np
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 
 st.set_page_config(
     page_title="江门仓库 | 库存与到货日历）",
@@ -19,29 +22,35 @@ DEFAULT_WAREHOUSE_KEYWORD = "江门"   # 只看江门仓相关记录（收货地
 DEFAULT_DAYS_FORWARD = 30            # 日历窗口天数
 
 # ---------------- 规范品名映射 ----------------
-RULES = [
+RULES = [  # 只用非捕获分组，BIG_RE 里只保留命名分组
     # —— 白色 ——
-    (r"白色粉末.*(T|甜).*", "白色粉末甜味优镁粉"),
-    (r"白色粉末.*(白皮).*", "白色粉末（白皮）"),
-    (r"白色粉末.*(优乐粉).*", "白色粉末优乐粉"),
+    (r"白色粉末.*(?:T|甜).*", "白色粉末甜味优镁粉"),
+    (r"白色粉末.*(?:白皮).*", "白色粉末（白皮）"),
+    (r"白色粉末.*(?:优乐粉).*", "白色粉末优乐粉"),
     (r"白色粉末.*优镁粉.*", "白色粉末优镁粉"),
     (r"白色粉末.*", "白色粉末优镁粉"),
     # —— 金黄色 ——
-    (r"金黄色粉末.*(新配方).*", "金黄色粉末优镁粉2号"),
+    (r"金黄色粉末.*(?:新配方).*", "金黄色粉末优镁粉2号"),
     (r"金黄色粉末.*1号.*", "金黄色粉末优镁粉1号"),
     (r"金黄色粉末.*2号.*", "金黄色粉末优镁粉2号"),
     (r"金黄色粉末.*优镁粉.*", "金黄色粉末优镁粉1号"),
     (r"金黄色粉末.*", "金黄色粉末优镁粉1号"),
     # —— 深黄色 ——
-    (r"深黄色粉末.*(T|甜).*", "深黄色粉末甜味优镁粉"),
+    (r"深黄色粉末.*(?:T|甜).*", "深黄色粉末甜味优镁粉"),
     (r"深黄色粉末.*优镁粉.*", "深黄色粉末优镁粉"),
     (r"深黄色粉末.*", "深黄色粉末优镁粉"),
     # —— 浅黄色 ——
     (r"浅黄色粉末.*", "浅黄色粉末优镁粉"),
     # —— 棕色号 ——
     (r"棕色.*1号.*", "棕色1号优镁粉"),
-    (r"棕色.*(0号|2号).*", "棕色2号优镁粉"),
+    (r"棕色.*(?:0号|2号).*", "棕色2号优镁粉"),
 ]
+# 所有规则并成一个带命名分组的交替式，一次匹配即可归类。
+# 每个分支带惰性前缀并从位置 0 开始 match：各分支按 RULES 顺序尝试，优先级与逐条 search 一致
+BIG_RE = re.compile("|".join(f"(?P<g{i}>(?s:.*?){p})" for i, (p, _) in enumerate(RULES)))
+GROUP_TO_TARGET = {f"g{i}": t for i, (_, t) in enumerate(RULES)}
+# “（白皮）<任意吨位>(装xxx)”这类后缀
+PREFIX_RE = re.compile(r"(（?白皮）?)\s*\d+(\.\d+)?\s*吨.*")
 
 PREFERRED_ORDER = [
     "白色粉末优镁粉","白色粉末甜味优镁粉","白色粉末（白皮）",
@@ -56,6 +65,12 @@ PALETTE = [
     "#F9E79F", "#85C1E9", "#ABEBC6", "#F8C471", "#F5CBA7",
 ]
 
+# 拆分后明细表（items_df）的列
+ITEM_COLUMNS = [
+    "箱号/封号", "原始品名", "产品", "数量(吨)",
+    "装货日期", "预计到港时间", "预计到货时间", "仓库/客户", "货运公司",
+]
+
 # ---------------- 交互：手机模式 & 简短标签 ----------------
 col0a, col0b = st.columns([1,1])
 with col0a:
@@ -89,47 +104,46 @@ def normalize_product(name: str) -> str | None:
     """把各种写法归一到规范品名；匹配不到时返回 None。"""
     s = str(name).strip()
     # 把“（白皮）<任意吨位>(装xxx)”这类后缀剪掉避免干扰
-    s = re.sub(r"(（?白皮）?)\s*\d+(\.\d+)?\s*吨.*", r"\1", s)
-    for pattern, target in RULES:
-        if re.search(pattern, s):
-            return target
-    return None
+    s = PREFIX_RE.sub(r"\1", s)
+    m = BIG_RE.match(s)
+    return GROUP_TO_TARGET[m.lastgroup] if m else None
+
+
+def normalize_product_series(names: pd.Series) -> pd.Series:
+    """normalize_product 的整列版本：每个名字只跑一次 BIG_RE.match，按命中的分组取规范品名。"""
+    return names.map(normalize_product)
 
 
 # ---------------- 工具函数 ----------------
 
-def split_product_items(row: pd.Series) -> list:
+def split_product_items(track_df: pd.DataFrame) -> pd.DataFrame:
     """把“产品”里的一柜多品拆成多行；抽取吨位，归一产品名，并保留关键字段。"""
-    items: List[dict] = []
-    prod_text = str(row.get("产品", ""))
-    parts = re.split(r"[+,，]", prod_text)
-    for p in parts:
-        p = p.strip()
-        m = re.search(r"([0-9]+(\.[0-9]+)?)\s*吨", p)
-        if not m:
-            continue
-        qty = float(m.group(1))
-        base = normalize_product(p)
-        if base is None:
-            continue  # 不是规范10类则跳过
-        items.append({
-            "箱号/封号": row.get("箱号/封号"),
-            "原始品名": p,
-            "产品": base,
-            "数量(吨)": qty,
-            "装货日期": row.get("装货日期"),
-            "预计到港时间": row.get("预计到港时间"),
-            "预计到货时间": row.get("预计到货时间"),
-            "仓库/客户": row.get("仓库/客户") or row.get("仓库客服"),
-            "货运公司": row.get("货运公司"),
-        })
-    return items
+    parts = track_df["产品"].astype(str).str.split(r"[+,，]", regex=True)
+    exploded = track_df.assign(_p=parts).explode("_p")
+    p = exploded["_p"].str.strip()
+    qty = p.str.extract(r"([0-9]+(?:\.[0-9]+)?)\s*吨", expand=False).astype(float)
+    exploded = exploded.assign(_p=p, **{"数量(吨)": qty}).dropna(subset=["数量(吨)"])
+    exploded = exploded.assign(产品=normalize_product_series(exploded["_p"]))
+    exploded = exploded.dropna(subset=["产品"])  # 不是规范10类则跳过
+    wh = exploded["仓库/客户"]
+    if "仓库客服" in exploded.columns:
+        # 仓库/客户 为空（Excel 空格读成 NaN，或空串）时用 仓库客服 补
+        wh = wh.where(wh.notna() & (wh != ""), exploded["仓库客服"])
+    # 按列直接拼出明细表（不再整表 assign 复制一遍再挑列）
+    cols = {"原始品名": exploded["_p"], "仓库/客户": wh}
+    return pd.DataFrame({c: (cols[c] if c in cols else exploded[c]).to_numpy() for c in ITEM_COLUMNS})
 
 
 def to_excel_bytes(df: pd.DataFrame, sheet_name="Sheet1") -> bytes:
+    """xlsxwriter 的 constant_memory 流式写法：每写完一行就落盘，内存不随行数增长。
+    constant_memory 只接受按行顺序写入，而 pandas 的 to_excel 是逐列写单元格，所以这里直接逐行写。"""
     bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine="xlsxwriter") as w:
-        df.to_excel(w, index=False, sheet_name=sheet_name)
+    with xlsxwriter.Workbook(bio, {"constant_memory": True}) as wb:
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, [str(c) for c in df.columns], wb.add_format({"bold": True, "border": 1, "align": "center"}))
+        # 空值写成空单元格（xlsxwriter 不接受 NaN）
+        for i, row in enumerate(df.astype(object).where(df.notna(), None).to_numpy().tolist(), start=1):
+            ws.write_row(i, 0, row)
     bio.seek(0)
     return bio.getvalue()
 
@@ -154,16 +168,145 @@ if not stock_file or not track_file:
     st.stop()
 
 
-def read_any(file):
-    name = file.name.lower()
-    if name.endswith(".csv"):
-        return pd.read_csv(file)
+@st.cache_data(show_spinner=False)
+def read_any(name: str, data: bytes) -> pd.DataFrame:
+    """按文件名后缀读表；以文件内容为缓存键，控件交互重跑时不再重复解析。"""
+    if name.lower().endswith(".csv"):
+        return pd.read_csv(io.BytesIO(data))
     else:
-        return pd.read_excel(file, sheet_name=0)
+        # calamine（Rust 实现）解析 xlsx/xls 比默认的 openpyxl 快得多
+        return pd.read_excel(io.BytesIO(data), sheet_name=0, engine="calamine")
+
+
+@st.cache_data(show_spinner=False)
+def load_and_normalize(upload_key: Tuple[str, str], _stock_df: pd.DataFrame, _track_df: pd.DataFrame, wh_keyword: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """仓库筛选 + 品名归一 + 拆柜，返回 (按产品汇总的库存表, 拆分后明细表)。
+    缓存键是两张上传文件的摘要 upload_key + 仓库关键词；下划线开头的 DataFrame 参数不参与哈希
+    （st.cache_data 对大表只抽样哈希，改动落在样本外会命中旧结果）。"""
+    stock_df, track_df = _stock_df, _track_df
+    # 只保留江门仓记录
+    mask = track_df["收货地址"].astype(str).str.contains(wh_keyword, na=False) | \
+           track_df.get("仓库/客户", pd.Series("", index=track_df.index)).astype(str).str.contains(wh_keyword, na=False)
+    track_df = track_df[mask].copy()
+
+    # ---------- 归一化：库存表的“产品”也归一，并做合并汇总 ----------
+    stock_df = stock_df.copy()
+    stock_df["产品"] = normalize_product_series(stock_df["产品"]).fillna(stock_df["产品"].astype(str))
+    # 修正棕色0号 → 2号
+    stock_df["产品"] = stock_df["产品"].replace({"棕色0号优镁粉": "棕色2号优镁粉"})
+    # 仅保留规范类目
+    stock_df = stock_df[stock_df["产品"].isin(PREFERRED_ORDER)]
+    # 备注：先一次性去掉空值，再用 C 实现的 str.join 按产品拼接，最后统一截断
+    notes = (stock_df.dropna(subset=["备注"])
+        .astype({"备注": str})
+        .groupby("产品")["备注"]
+        .agg("；".join)
+    )
+    stock_df = (stock_df
+        .groupby("产品")
+        .agg({
+            "江门实际库存数量": "sum",
+            "记录库存数量": "sum",
+        })
+        .join(notes)
+        .reset_index()
+    )
+    stock_df["备注"] = stock_df["备注"].fillna("").astype(str).str.slice(0, 200)
+
+    # 拆分产品（一个箱号→多行）
+    items_df = split_product_items(track_df)
+
+    # 规范日期列 —— 全部使用 Timestamp，避免与 date 比较报错
+    for col in ["装货日期","预计到港时间","预计到货时间"]:
+        if col in items_df.columns:
+            items_df[col] = pd.to_datetime(items_df[col], errors="coerce")
 
+    # 低基数的文本列转成 category：后面的 groupby / isin / unique 都走整数编码
+    # 产品按 PREFERRED_ORDER 排序（其余归一结果排在后面），箱号基本一柜一个，不转
+    extra = sorted(set(items_df["产品"]) - set(PREFERRED_ORDER))
+    items_df["产品"] = pd.Categorical(items_df["产品"], categories=PREFERRED_ORDER + extra, ordered=True)
+    for col in ["货运公司", "仓库/客户"]:
+        items_df[col] = items_df[col].astype("category")
+    return stock_df, items_df
 
-stock_df = read_any(stock_file)
-track_df = read_any(track_file)
+
+# ================== 汇总（产品） ==================
+@st.cache_data(show_spinner=False)
+def build_summary(upload_key: Tuple[str, str], wh_keyword: str, _stock_df: pd.DataFrame, _items_df: pd.DataFrame, today: date, cutoff: date) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """按起始日/截止日算在途与预计库存，返回 (在途明细, 产品汇总表)。
+    _stock_df/_items_df 由 (upload_key, wh_keyword) 决定，缓存键只用这两个和日期。"""
+    stock_df, items_df = _stock_df, _items_df
+    # 比较用的今天/截止日（Timestamp）
+    today_ts = pd.to_datetime(today)
+    cutoff_ts = pd.to_datetime(cutoff)
+
+    # 在途定义：预计到货为空 或 预计到货 >= 今天
+    # 日期比较都在 int64 纳秒上做（NaT 即 pd.NaT.value），跳过 Timestamp/NaT 的逐元素处理
+    eta_ns = items_df["预计到货时间"].to_numpy("datetime64[ns]").view("i8")
+    intransit_df = items_df[(eta_ns == pd.NaT.value) | (eta_ns >= today_ts.value)].copy()
+
+    # 1) 为每条在途记录生成“装货日期YYYY-MM-DD（N天到）”标签，其中 N = 预计到港 - 装货（整列计算）
+    ship = intransit_df["装货日期"]
+    # 预计到港缺失时用预计到货代替
+    eta_port = intransit_df["预计到港时间"].fillna(intransit_df["预计到货时间"])
+    days = (eta_port.dt.normalize() - ship.dt.normalize()).dt.days
+    label = "装货日期" + ship.dt.strftime("%Y-%m-%d") + "（" + days.astype("Int64").astype(str) + "天到）"
+    intransit_df["装货标签"] = label.where(ship.notna() & eta_port.notna())
+
+    # 2) 生成“装货标签”宽表（每个标签一列，值为数量）
+    #    装货日作为列的外层键一起 unstack，按它排序即是标签的日期顺序（从小到大），无需再解析列名
+    labeled = intransit_df.dropna(subset=["装货标签"])
+    lab_tbl = (
+        labeled.groupby(["产品", labeled["装货日期"].dt.normalize().rename("_装货日"), "装货标签"], observed=True)['数量(吨)'] \
+            .sum() \
+            .unstack(["_装货日", "装货标签"], fill_value=0.0) \
+            .sort_index(axis=1, level=0) \
+            .droplevel(0, axis=1)
+    )
+    lab_tbl = lab_tbl.reset_index()
+
+    # 3) 在途总和（运送途中数量）+ 4) 截止某日预计入库：只把“在途且预计到货<=截止日”的数量算进来
+    #    两个合计共用一次 groupby：截止日之后到货的数量先置 0 再求和
+    arrive_ns = intransit_df["预计到货时间"].fillna(intransit_df["预计到港时间"]).to_numpy("datetime64[ns]").view("i8")
+    arrived = (arrive_ns != pd.NaT.value) & (arrive_ns <= cutoff_ts.value)
+    qty_sums = (intransit_df
+        .assign(_arr=intransit_df["数量(吨)"].where(arrived, 0.0))
+        .groupby("产品", observed=True)
+        .agg(运送途中数量=("数量(吨)", "sum"), 截止日预计到货=("_arr", "sum"))
+        .reset_index()
+    )
+
+    # 5) 合并库存 + 标签宽表 + 在途合计 + 截止预计入库，并计算“预计江门库存数量（截止X日）”
+    summary_df = stock_df.merge(lab_tbl, on="产品", how="outer")
+    summary_df = summary_df.merge(qty_sums, on="产品", how="left")
+    summary_df[["运送途中数量","截止日预计到货"]] = summary_df[["运送途中数量","截止日预计到货"]].fillna(0.0)
+    summary_df[["江门实际库存数量","记录库存数量","备注"]] = summary_df[["江门实际库存数量","记录库存数量","备注"]].fillna({"江门实际库存数量":0.0,"记录库存数量":0.0,"备注":""})
+    summary_df[f"预计江门库存数量（截止{cutoff_ts.strftime('%Y-%m-%d')}）"] = summary_df["江门实际库存数量"] + summary_df["截止日预计到货"]
+
+    # 6) 排序：先按指定产品顺序，再按装货日期列顺序
+    #    先滤掉不在清单里的产品，再转成按 PREFERRED_ORDER 排序的 category，按编码排序即可
+    #    （直接转换会把清单外的值静默变成 NaN，新版 pandas 对此告警并将改为报错）
+    summary_df = summary_df[summary_df["产品"].isin(PREFERRED_ORDER)].copy()
+    summary_df["产品"] = pd.Categorical(summary_df["产品"], categories=PREFERRED_ORDER, ordered=True)
+    summary_df = summary_df.sort_values("产品")
+
+    # 7) 列顺序：产品 | 实际库存 | 各装货标签... | 运送途中数量 | 截止预计到货 | 预计库存(截止) | 记录库存 | 备注
+    label_cols = [c for c in summary_df.columns if str(c).startswith("装货日期")]  # 已按日期排序
+    final_cols = [
+        "产品","江门实际库存数量", *label_cols, "运送途中数量","截止日预计到货",
+        f"预计江门库存数量（截止{cutoff_ts.strftime('%Y-%m-%d')}）","记录库存数量","备注"
+    ]
+    return intransit_df, summary_df.reindex(columns=final_cols)
+
+
+stock_bytes, track_bytes = stock_file.getvalue(), track_file.getvalue()
+stock_df = read_any(stock_file.name, stock_bytes)
+track_df = read_any(track_file.name, track_bytes)
+# 上传内容的摘要：下游缓存都以它为键，不去哈希整张 DataFrame
+upload_key = (
+    hashlib.sha256(stock_file.name.encode("utf-8") + b"\0" + stock_bytes).hexdigest(),
+    hashlib.sha256(track_file.name.encode("utf-8") + b"\0" + track_bytes).hexdigest(),
+)
 
 # 列校验
 need_track_cols = {"序号","装货日期","装货地址","收货地址","仓库/客户","产品","箱号/封号","预计到港时间","预计到货时间","货运公司"}
@@ -177,101 +320,11 @@ if miss2:
     st.error(f"【库存盘点】缺少列：{', '.join(miss2)}")
     st.stop()
 
-# 只保留江门仓记录
-mask = track_df["收货地址"].astype(str).str.contains(wh_keyword, na=False) | \
-       track_df.get("仓库/客户", pd.Series("", index=track_df.index)).astype(str).str.contains(wh_keyword, na=False)
-track_df = track_df[mask].copy()
-
-# ---------- 归一化：库存表的“产品”也归一，并做合并汇总 ----------
-stock_df["产品"] = stock_df["产品"].apply(lambda x: normalize_product(x) or str(x))
-# 修正棕色0号 → 2号
-stock_df["产品"] = stock_df["产品"].replace({"棕色0号优镁粉": "棕色2号优镁粉"})
-# 仅保留规范类目
-stock_df = stock_df[stock_df["产品"].isin(PREFERRED_ORDER)]
-stock_df = (stock_df
-    .groupby("产品", as_index=False)
-    .agg({
-        "江门实际库存数量": "sum",
-        "记录库存数量": "sum",
-        "备注": lambda s: "；".join([str(x) for x in s if pd.notna(x)])[:200]
-    })
-)
-
-# 拆分产品（一个箱号→多行）
-item_rows: List[dict] = []
-for _, r in track_df.iterrows():
-    item_rows.extend(split_product_items(r))
-items_df = pd.DataFrame(item_rows)
-
-# 规范日期列 —— 全部使用 Timestamp，避免与 date 比较报错
-for col in ["装货日期","预计到港时间","预计到货时间"]:
-    if col in items_df.columns:
-        items_df[col] = pd.to_datetime(items_df[col], errors="coerce")
-
-# 比较用的今天/截止日（Timestamp）
-today_ts = pd.to_datetime(today)
+# 源表解析/归一与汇总都走缓存：只有上传文件、仓库关键词或日期变化时才重算
+stock_df, items_df = load_and_normalize(upload_key, stock_df, track_df, wh_keyword)
+intransit_df, summary_df = build_summary(upload_key, wh_keyword, stock_df, items_df, today, cutoff)
 cutoff_ts = pd.to_datetime(cutoff)
-
-# 在途定义：预计到货为空 或 预计到货 >= 今天
-intransit_df = items_df[(items_df["预计到货时间"].isna()) | (items_df["预计到货时间"] >= today_ts)].copy()
-
-# ================== 汇总（产品） ==================
-# 1) 为每条在途记录生成“装货日期YYYY-MM-DD（N天到）”标签，其中 N = 预计到港 - 装货
-
-def label_for(row: pd.Series) -> str | None:
-    ship = row.get("装货日期")
-    eta_port = row.get("预计到港时间") or row.get("预计到货时间")
-    if pd.isna(ship) or pd.isna(eta_port):
-        return None
-    days = (eta_port.normalize() - ship.normalize()).days
-    return f"装货日期{ship.strftime('%Y-%m-%d')}（{days}天到）"
-
-intransit_df["装货标签"] = intransit_df.apply(label_for, axis=1)
-
-# 2) 生成“装货标签”宽表（每个标签一列，值为数量）
-lab_tbl = (
-    intransit_df.dropna(subset=["装货标签"]) \
-        .groupby(["产品","装货标签"])['数量(吨)'] \
-        .sum() \
-        .unstack(fill_value=0.0)
-)
-# 标签列按日期排序（从小到大）
-if not lab_tbl.empty:
-    def _key(c):
-        m = re.search(r"装货日期(\d{4}-\d{2}-\d{2})", str(c))
-        return m.group(1) if m else "9999-99-99"
-    lab_tbl = lab_tbl.reindex(sorted(lab_tbl.columns, key=_key), axis=1)
-
-lab_tbl = lab_tbl.reset_index()
-
-# 3) 在途总和（运送途中数量）
-intransit_sum = intransit_df.groupby("产品")["数量(吨)"].sum().rename("运送途中数量").reset_index()
-
-# 4) 截止某日预计入库：只把“在途且预计到货<=截止日”的数量算进来
-eta_col = intransit_df["预计到货时间"].fillna(intransit_df["预计到港时间"])
-arrive_by_cutoff = intransit_df[eta_col <= cutoff_ts].groupby("产品")["数量(吨)"].sum().rename("截止日预计到货").reset_index()
-
-# 5) 合并库存 + 标签宽表 + 在途合计 + 截止预计入库，并计算“预计江门库存数量（截止X日）”
-summary_df = stock_df.merge(lab_tbl, on="产品", how="outer")
-summary_df = summary_df.merge(intransit_sum, on="产品", how="left")
-summary_df = summary_df.merge(arrive_by_cutoff, on="产品", how="left")
-summary_df[["运送途中数量","截止日预计到货"]] = summary_df[["运送途中数量","截止日预计到货"]].fillna(0.0)
-summary_df[["江门实际库存数量","记录库存数量","备注"]] = summary_df[["江门实际库存数量","记录库存数量","备注"]].fillna({"江门实际库存数量":0.0,"记录库存数量":0.0,"备注":""})
-summary_df[f"预计江门库存数量（截止{cutoff_ts.strftime('%Y-%m-%d')}）"] = summary_df["江门实际库存数量"] + summary_df["截止日预计到货"]
-
-# 6) 排序：先按指定产品顺序，再按装货日期列顺序
-order_map = {name:i for i,name in enumerate(PREFERRED_ORDER)}
-summary_df["__ord__"] = summary_df["产品"].map(order_map).fillna(9999)
-summary_df = summary_df[summary_df["产品"].isin(PREFERRED_ORDER)]
-summary_df = summary_df.sort_values(["__ord__","产品"]).drop(columns="__ord__")
-
-# 7) 列顺序：产品 | 实际库存 | 各装货标签... | 运送途中数量 | 截止预计到货 | 预计库存(截止) | 记录库存 | 备注
 label_cols = [c for c in summary_df.columns if str(c).startswith("装货日期")]  # 已按日期排序
-final_cols = [
-    "产品","江门实际库存数量", *label_cols, "运送途中数量","截止日预计到货",
-    f"预计江门库存数量（截止{cutoff_ts.strftime('%Y-%m-%d')}）","记录库存数量","备注"
-]
-summary_df = summary_df.reindex(columns=final_cols)
 
 # —— 手机端只展示核心列（其余下载查看）
 if is_mobile:
@@ -305,40 +358,60 @@ st.download_button(
 carriers = [c for c in intransit_df["货运公司"].dropna().unique().tolist()]
 color_map: Dict[str,str] = {c: PALETTE[i % len(PALETTE)] for i, c in enumerate(sorted(carriers))}
 
-def make_events_for_product(prod: str, window_start: date, days: int) -> List[dict]:
-    window_end = window_start + timedelta(days=days-1)
-    df = intransit_df[intransit_df["产品"] == prod].copy()
-    events: List[dict] = []
-    for _, r in df.iterrows():
-        s_ts = r.get("装货日期")
-        e_ts = r.get("预计到货时间") or r.get("预计到港时间")
-        if pd.isna(s_ts):
-            continue
-        if pd.isna(e_ts):
-            e_ts = s_ts + pd.Timedelta(days=7)
-        start_full = s_ts.normalize().date()
-        end_full = e_ts.normalize().date()
-        # 用于渲染的窗口裁剪
-        s = max(start_full, window_start)
-        e = min(end_full, window_end)
-        if s > e:
-            continue
-        days_total = (end_full - start_full).days + 1
-        events.append({
-            "start": s, "end": e,
-            "datestr": f"{start_full:%Y-%m-%d} ~ {end_full:%Y-%m-%d}",
-            "days": days_total,
-            "qty": r.get("数量(吨)") or 0,
-            "carrier": r.get("货运公司") or "",
-            "warehouse": r.get("仓库/客户") or "",
-            "container": r.get("箱号/封号") or ""
-        })
-    return events
+def group_by_product(intransit_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """在途明细按产品一次分好组，之后按产品直接取组，不再逐产品扫描整张在途表。"""
+    return {p: g.reset_index(drop=True) for p, g in intransit_df.groupby("产品", sort=False, observed=True)}
+
 
+intransit_by_prod = group_by_product(intransit_df)
 
-def build_calendar_html_events_grid(product: str, window_start: date, days: int, events: List[dict], *, compact: bool=False, short_label: bool=False) -> str:
+def make_events_for_product(prod: str, window_start: date, days: int, grouped: Dict[str, pd.DataFrame] | None = None) -> List[dict]:
     window_end = window_start + timedelta(days=days-1)
-    css = f"""
+    df = (intransit_by_prod if grouped is None else grouped).get(prod)
+    if df is None:
+        return []
+    df = df[df["装货日期"].notna()]
+    # 日期一律取到“天”（datetime64[D]），裁剪/比较在 int64 天数上做
+    start_full = df["装货日期"].to_numpy("datetime64[D]")
+    end_full = df["预计到货时间"].fillna(df["预计到港时间"]).to_numpy("datetime64[D]")
+    # 预计到货缺失时退回预计到港，仍缺失则按装货后 7 天画
+    end_full = np.where(np.isnat(end_full), start_full + np.timedelta64(7, "D"), end_full)
+    start_d, end_d = start_full.view("i8"), end_full.view("i8")
+    # 用于渲染的窗口裁剪
+    s = np.maximum(start_d, np.datetime64(window_start, "D").astype("i8"))
+    e = np.minimum(end_d, np.datetime64(window_end, "D").astype("i8"))
+    keep = s <= e
+    df = df[keep]
+    return [
+        {
+            "start": s_, "end": e_,
+            "datestr": f"{sf} ~ {ef}", "days": n,
+            "qty": qty, "carrier": carrier, "warehouse": wh, "container": box,
+        }
+        for s_, e_, sf, ef, n, qty, carrier, wh, box in zip(
+            s[keep].astype("datetime64[D]").tolist(), e[keep].astype("datetime64[D]").tolist(),
+            np.datetime_as_string(start_full[keep]), np.datetime_as_string(end_full[keep]),
+            (end_d - start_d + 1)[keep].tolist(), df["数量(吨)"].fillna(0).to_numpy().tolist(),
+            df["货运公司"].astype(object).fillna("").to_numpy().tolist(),
+            df["仓库/客户"].astype(object).fillna("").to_numpy().tolist(),
+            df["箱号/封号"].fillna("").to_numpy().tolist(),
+        )
+    ]
+
+
+_CAL = calendar.Calendar(firstweekday=0)  # 周一开头
+
+
+@functools.lru_cache(maxsize=64)
+def _month_grid(y: int, m: int) -> List[List[date]]:
+    """某月的按周日期网格；各产品的日历共用，同一月份只算一次。"""
+    return _CAL.monthdatescalendar(y, m)
+
+
+@functools.lru_cache(maxsize=2)
+def _css(compact: bool) -> str:
+    """日历页的样式块，只随 compact 变化，各产品共用。"""
+    return f"""
     <style>
     body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial; margin:16px; }}
     .month {{ margin-bottom: 24px; }}
@@ -360,6 +433,22 @@ def build_calendar_html_events_grid(product: str, window_start: date, days: int,
     </style>
     """
 
+
+# 用户数据（公司/仓库/箱号/品名）写进 HTML 前转义；str.translate 走 C 实现，一次替换全部字符
+_ESCAPE = str.maketrans({"<": "&lt;", ">": "&gt;", "&": "&amp;", '"': "&quot;", "'": "&#39;"})
+
+
+def _esc(s) -> str:
+    return str(s).translate(_ESCAPE)
+
+
+# 参数（含 events 与 color_map）即缓存键：切换产品/开关时，同样的组合直接复用已渲染的 HTML
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_calendar_html_events_grid(product: str, window_start: date, days: int, events: List[dict], *, color_map: Dict[str,str], compact: bool=False, short_label: bool=False) -> str:
+    window_end = window_start + timedelta(days=days-1)
+    css = _css(compact)
+    product = _esc(product)
+
     # 按月分组
     months = []
     cur = window_start.replace(day=1)
@@ -370,58 +459,68 @@ def build_calendar_html_events_grid(product: str, window_start: date, days: int,
         else:
             cur = date(cur.year, cur.month+1, 1)
 
+    # 每个事件的文本/颜色与所在周无关，先算好一次；并按覆盖到的周（周一的序数日）分桶，
+    # 渲染时每周只看落在本周的事件
+    bars_by_week: Dict[int, list] = defaultdict(list)
+    for ev in events:
+        carrier = _esc(ev['carrier'])
+        if short_label:
+            label = f"{ev['qty']:g}吨｜{carrier}｜{ev['datestr']}（{ev['days']}天）"
+        else:
+            label = (
+                f"{ev['qty']:g} 吨｜{carrier}/{_esc(ev['warehouse'])}｜"
+                f"箱:{_esc(ev['container'])}｜{ev['datestr']}（{ev['days']}天）"
+            )
+        bar = (ev["start"], ev["end"], label, color_map.get(ev['carrier'], '#e8e8e8'))
+        first_wk = ev["start"].toordinal() - ev["start"].weekday()
+        last_wk = ev["end"].toordinal() - ev["end"].weekday()
+        for wk in range(first_wk, last_wk + 1, 7):
+            bars_by_week[wk].append(bar)
+
+    # 整个文档只用一个 parts 列表，最后一次性 join
+    parts: List[str] = []
+    _append = parts.append
+
     # 头部：meta viewport + 图例
-    head = (
+    _append(
         "<!DOCTYPE html><html><head>"
         "<meta charset='utf-8'>"
         "<meta name='viewport' content='width=device-width, initial-scale=1'>"
         f"<title>{product} 到货月历</title>{css}</head><body>"
         f"<h2>{product} ：{window_start} ~ {window_end}</h2>"
-        + "<div class='legend'>" + "".join([f"<span class='tag' style='background:{color_map.get(c, '#eee')}'>{c or '未知公司'}</span>" for c in color_map]) + "</div>"
     )
-
-    html = [head]
-
-    cal = calendar.Calendar(firstweekday=0)  # 周一开头
+    _append("<div class='legend'>" + "".join([f"<span class='tag' style='background:{color_map.get(c, '#eee')}'>{_esc(c) or '未知公司'}</span>" for c in color_map]) + "</div>")
 
     for y, m in months:
-        html.append(f"<div class='month'><div class='month-title'>{y}年{m}月</div>")
-        for week in cal.monthdatescalendar(y, m):  # 每个 week 是 7 天的 date 列表
+        _append(f"<div class='month'><div class='month-title'>{y}年{m}月</div>")
+        for week in _month_grid(y, m):  # 每个 week 是 7 天的 date 列表
             week_start, week_end = week[0], week[-1]
+            _append("<div class='week'><div class='grid'>")
             # 1) 先画每日方格
-            day_cells = []
             for d in week:
                 muted = " muted" if d.month != m else ""
-                day_cells.append(f"<div class='day{muted}'><div class='n'>{d.day}</div></div>")
-            # 2) bars：把与这一周相交的事件画成跨列条
-            bar_divs = []
-            for ev in events:
-                seg_start = max(ev["start"], week_start)
-                seg_end   = min(ev["end"],   week_end)
-                if seg_start > seg_end:
-                    continue
+                _append(f"<div class='day{muted}'><div class='n'>{d.day}</div></div>")
+            _append("</div>")
+            # 2) bars：把与这一周相交的事件画成跨列条；本周没有事件就不输出 bars
+            week_bars = bars_by_week.get(week_start.toordinal(), ())
+            if week_bars:
+                _append("<div class='bars'>")
+            for ev_start, ev_end, label, bar_color in week_bars:
+                seg_start = max(ev_start, week_start)
+                seg_end   = min(ev_end,   week_end)
                 start_idx = seg_start.weekday()  # 0..6
                 span = (seg_end - seg_start).days + 1
-                if short_label:
-                    label = f"{ev['qty']:g}吨｜{ev['carrier']}｜{ev['datestr']}（{ev['days']}天）"
-                else:
-                    label = (
-                        f"{ev['qty']:g} 吨｜{ev['carrier']}/{ev['warehouse']}｜"
-                        f"箱:{ev['container']}｜{ev['datestr']}（{ev['days']}天）"
-                    )
-                bar_color = color_map.get(ev['carrier'], '#e8e8e8')
-                bar_divs.append(
+                _append(
                     f"<div class='bar' title='{label}' style='grid-column:{start_idx+1} / span {span}; background:{bar_color}'>"
                     f"{label}</div>"
                 )
-            html.append("<div class='week'>")
-            html.append("<div class='grid'>" + "".join(day_cells) + "</div>")
-            html.append("<div class='bars'>" + "".join(bar_divs) + "</div>")
-            html.append("</div>")
-        html.append("</div>")
+            if week_bars:
+                _append("</div>")
+            _append("</div>")
+        _append("</div>")
 
-    html.append("</body></html>")
-    return "\n".join(html)
+    _append("</body></html>")
+    return "\n".join(parts)
 
 
 # 页面内预览（单个产品）
@@ -432,18 +531,21 @@ if prod_opt:
     # 移动端默认窗口短一点更清楚
     win_days = min(days_forward, 21) if is_mobile else days_forward
     evts = make_events_for_product(prod_opt, today, win_days)
-    html = build_calendar_html_events_grid(prod_opt, today, win_days, evts, compact=is_mobile, short_label=short_label)
+    html = build_calendar_html_events_grid(prod_opt, today, win_days, evts, color_map=color_map, compact=is_mobile, short_label=short_label)
     st.components.v1.html(html, height=540 if is_mobile else 660, scrolling=True)
 
 
 # 打包下载：每产品一个 HTML + index（继承手机样式）
-def build_zip_calendars(all_prods, compact: bool, short_label: bool):
+@st.cache_data(show_spinner=False)
+def build_zip_calendars(all_prods, upload_key: Tuple[str, str], wh_keyword: str, _intransit_df: pd.DataFrame, window_start: date, days: int, color_map: Dict[str,str], *, compact: bool, short_label: bool):
+    # _intransit_df 不参与哈希：它由 (upload_key, wh_keyword, window_start) 决定
+    grouped = group_by_product(_intransit_df)
     buf = io.BytesIO()
     with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
         index_lines = [f"<html><head><meta charset='utf-8'><meta name='viewport' content='width=device-width, initial-scale=1'><title>产品到货日历索引</title></head><body><h2>产品到货日历（连续事件条）</h2><ul>"]
         for prod in all_prods:
-            evts = make_events_for_product(prod, today, days_forward)
-            html = build_calendar_html_events_grid(prod, today, days_forward, evts, compact=compact, short_label=short_label)
+            evts = make_events_for_product(prod, window_start, days, grouped)
+            html = build_calendar_html_events_grid(prod, window_start, days, evts, color_map=color_map, compact=compact, short_label=short_label)
             fname = f"calendar_{prod}.html"
             z.writestr(fname, html)
             index_lines.append(f"<li><a href='{fname}'>{prod}</a></li>")
@@ -454,7 +556,7 @@ def build_zip_calendars(all_prods, compact: bool, short_label: bool):
 
 st.download_button(
     "下载：日历视图（HTML 打包，连续事件条）.zip",
-    build_zip_calendars(products_with_data, compact=is_mobile, short_label=short_label),
+    build_zip_calendars(products_with_data, upload_key, wh_keyword, intransit_df, today, days_forward, color_map, compact=is_mobile, short_label=short_label),
     file_name="产品到货_连续事件条_月历_HTML打包.zip",
     mime="application/zip"
 )